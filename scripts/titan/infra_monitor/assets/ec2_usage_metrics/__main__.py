@@ -11,17 +11,18 @@ logger = logging.getLogger(__name__)
 class ArgValidator:
     
     @classmethod
-    def ensure_valid_json_file_path(cls, json_file_path: str):
+    def load_valid_json_file(cls, json_file_path: str):
         try:
             with open(json_file_path, 'r') as f:
-                json.loads(f.read())
-        except:
+                return json.load(f)
+        except (OSError, TypeError, ValueError):
             raise ValueError(f"Invalid JSON file path `{json_file_path}` !")
 
 
 def main():
     parser = argparse.ArgumentParser(description="Local Runner For Lambda Function")
     parser.add_argument("-e", "--event-file", type=str, required=False, help="Path to json file containing event")
+    parser.add_argument("-o", "--output-file", type=str, required=False, help="Path to write the json response to, instead of printing it")
     args = parser.parse_args()
 
     # configure the logger
@@ -29,11 +30,13 @@ def main():
 
 
     try:
-        ArgValidator.ensure_valid_json_file_path(args.event_file)
-
-        with open(args.event_file, 'r') as f:
-            response = lambda_handler(  event=json.loads(f.read()),
-                                        context={} )
+        event = ArgValidator.load_valid_json_file(args.event_file)
+        response = lambda_handler(  event=event,
+                                    context={} )
+        if args.output_file:
+            with open(args.output_file, 'w') as f:
+                json.dump(response, f)
+        else:
             print(json.dumps(response, indent=4))
 
     except Exception as e:
@@ -1,83 +1,120 @@
 #!/usr/bin/env python3
 
 import json
-import os
 import logging
-import boto3
+import collections
+import concurrent.futures
+import botocore.config
+import botocore.session
+import botocore.exceptions
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# created once per execution context so that warm invocations reuse them
+boto_config = botocore.config.Config(   max_pool_connections=16,
+                                        retries={'mode': 'adaptive', 'max_attempts': 10}  )
+boto_session = botocore.session.get_session()
+ec2_client = boto_session.create_client('ec2', config=boto_config)
+cloudwatch_client = boto_session.create_client('cloudwatch', config=boto_config)
 
-class LambdaHelper:
-
-    def get_current_region():
-        return os.environ['AWS_REGION']
 
 class CustomCloudWatchMetrics:
 
+    # PutMetricData accepts up to 1000 datums and a 1 MB request payload
+    MAX_METRICS_PER_CALL = 1000
+    MAX_BYTES_PER_CALL = 900 * 1024
+
+    @classmethod
+    def gen_metric_chunks(cls, metric_dicts):
+        # a chunk is flushed as soon as either limit would be exceeded
+        metric_chunk = []
+        chunk_bytes = 0
+        for metric_dict in metric_dicts:
+            metric_bytes = len(json.dumps(metric_dict))
+            if metric_chunk and ((len(metric_chunk) == cls.MAX_METRICS_PER_CALL) or (chunk_bytes + metric_bytes > cls.MAX_BYTES_PER_CALL)):
+                yield metric_chunk
+                metric_chunk = []
+                chunk_bytes = 0
+            metric_chunk.append(metric_dict)
+            chunk_bytes += metric_bytes
+        if metric_chunk:
+            yield metric_chunk
+
+    @classmethod
+    def publish_chunk(cls, cloudwatch, metric_chunk):
+        # a failed call raises rather than returning a non-200 response, log it and let the other chunks carry on
+        try:
+            cloudwatch.put_metric_data( MetricData=metric_chunk,
+                                        Namespace='InfraMonitor' )
+            return (len(metric_chunk), len(metric_chunk))
+        except botocore.exceptions.ClientError as e:
+            logger.error("Failed to publish %d metrics: %s", len(metric_chunk), e)
+            return (len(metric_chunk), 0)
+
     @classmethod
     def publish(cls, metric_dicts):
+        MAX_CONCURRENT_CALLS = 8
+        num_metrics_received = 0
         num_metrics_published = 0
-        MAX_METRICS_PER_CALL = 20
-        cloudwatch = boto3.client('cloudwatch')
-        for metric_chunk in [metric_dicts[i:i+MAX_METRICS_PER_CALL] for i in range(0, len(metric_dicts), MAX_METRICS_PER_CALL)]:
-            response = cloudwatch.put_metric_data(  MetricData=metric_chunk,
-                                                    Namespace='InfraMonitor' )
-
-            try:
-                assert response['ResponseMetadata']['HTTPStatusCode'] == 200
-                num_metrics_published += len(metric_chunk)
-            except (KeyError, AssertionError) as e:
-                logger.error(f"Failed to publish metrics: {response}")
-                break
-        return num_metrics_published
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_CALLS) as executor:
+            for num_received, num_published in executor.map(lambda metric_chunk: cls.publish_chunk(cloudwatch_client, metric_chunk),
+                                                            cls.gen_metric_chunks(metric_dicts)):
+                num_metrics_received += num_received
+                num_metrics_published += num_published
+        return (num_metrics_received, num_metrics_published)
 
 
 
 
 class Ec2ResourceQuery:
 
-    @classmethod
-    def gen_instance_dicts(cls):
-        ec2 = boto3.resource('ec2')
-        for instance in ec2.instances.all():
-            yield { 'id': instance.id,
-                    'type': instance.instance_type,
-                    'state': instance.state['Name'] }
+    INSTANCE_STATES = ( 'pending',
+                        'running',
+                        'stopping',
+                        'stopped',
+                        'shutting-down',
+                        'terminated' )
+
+    # terminated instances linger in DescribeInstances for up to an hour, so they are skipped
+    # server-side and no count is published for them
+    REPORTED_INSTANCE_STATES = tuple(i_state for i_state in INSTANCE_STATES if i_state != 'terminated')
+
+    INSTANCE_COUNT_PER_STATE_TEMPLATE = {
+        'MetricName': 'InstanceCountPerState',
+        'Unit': 'None'
+    }
+
+    INSTANCE_COUNT_PER_STATE_AND_TYPE_TEMPLATE = {
+        'MetricName': 'InstanceCountPerStateAndType',
+        'Unit': 'None'
+    }
 
     @classmethod
     def gen_instance_count_metrics(cls):
-        per_state_count = {
-            'pending': 0,
-            'running': 0,
-            'stopping': 0,
-            'stopped': 0,
-            'shutting-down': 0,
-            'terminated': 0,
-        }
-        per_state_and_type_count = {}
-        for instance_dict in cls.gen_instance_dicts():
-            per_state_count[instance_dict['state']] += 1
-            try:
-                per_state_and_type_count[(instance_dict['type'], instance_dict['state'])] += 1
-            except KeyError:
-                per_state_and_type_count[(instance_dict['type'], instance_dict['state'])] = 1
+        per_state_count = collections.Counter(dict.fromkeys(cls.REPORTED_INSTANCE_STATES, 0))
+        per_state_and_type_count = collections.Counter()
+        paginator = ec2_client.get_paginator('describe_instances')
+        for page in paginator.paginate( Filters=[{'Name': 'instance-state-name', 'Values': list(cls.REPORTED_INSTANCE_STATES)}],
+                                        PaginationConfig={'PageSize': 1000} ):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    per_state_count[instance['State']['Name']] += 1
+                    per_state_and_type_count[(instance['InstanceType'], instance['State']['Name'])] += 1
         for i_state, count in per_state_count.items():
             yield {
-                'MetricName': 'InstanceCountPerState',
+                **cls.INSTANCE_COUNT_PER_STATE_TEMPLATE,
                 'Dimensions': [
                     {
                         'Name': 'InstanceState',
                         'Value': i_state
                     }
                 ],
-                'Unit': 'None',
                 'Value': count
             }
-        for i_type, i_state in per_state_and_type_count.keys():
+        for (i_type, i_state), count in per_state_and_type_count.items():
             yield {
-                'MetricName': 'InstanceCountPerStateAndType',
+                **cls.INSTANCE_COUNT_PER_STATE_AND_TYPE_TEMPLATE,
                 'Dimensions': [
                     {
                         'Name': 'InstanceType',
@@ -88,16 +125,14 @@ class Ec2ResourceQuery:
                         'Value': i_state
                     }
                 ],
-                'Unit': 'None',
-                'Value': per_state_and_type_count[(i_type, i_state)]
+                'Value': count
             }
 
 
 def lambda_handler(event, context):
-    instance_count_metrics = list(Ec2ResourceQuery.gen_instance_count_metrics())
-    num_metrics_published = CustomCloudWatchMetrics.publish(instance_count_metrics)
+    num_metrics_received, num_metrics_published = CustomCloudWatchMetrics.publish(Ec2ResourceQuery.gen_instance_count_metrics())
     return {
-        'success': (num_metrics_published == len(instance_count_metrics)),            
-        'received-metrics': len(instance_count_metrics),
+        'success': (num_metrics_published == num_metrics_received),
+        'received-metrics': num_metrics_received,
         'published-metrics': num_metrics_published
     }
\ No newline at end of file
@@ -1,18 +1,20 @@
 #!/usr/bin/env python3
 
 import json
+import io
+import re
 import typing
 import os
-import csv
-import zipfile
 import logging
-import botocore
-import tempfile
+import botocore.config
+import botocore.exceptions
 import pathlib
-import boto3
 from datetime import datetime
 import enum
-import slack_sdk
+import functools
+import collections
+import concurrent.futures
+import threading
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -46,38 +48,57 @@ class InfraHelper:
                 'me-south-1',
                 'sa-east-1' }
 
+    # longest names first so that the alternation always prefers the longest matching region
+    REGION_PATTERN = re.compile('|'.join(re.escape(region) for region in sorted(REGIONS, key=lambda region: (-len(region), region))))
+
+    # helpers outlive a single invocation so that warm containers reuse their sessions and clients
+    _region_helpers = {}
+    _region_helpers_lock = threading.Lock()
 
     def __init__(self, region):
         self._region = region
         self._clients = {}        
         self._boto_session = None
+        # a region listed twice shares its helper between threads, and creating clients off a session is not thread-safe
+        self._clients_lock = threading.Lock()
+
+    @classmethod
+    def for_region(cls, region):
+        with cls._region_helpers_lock:
+            try:
+                return cls._region_helpers[region]
+            except KeyError:
+                cls._region_helpers[region] = cls(region=region)
+                return cls._region_helpers[region]
 
     def region(self):
         return self._region
 
     def boto_session(self):
         if not self._boto_session:
+            import boto3
             self._boto_session = boto3.session.Session(region_name=self.region())
         return self._boto_session
 
     def boto_config(self):
-        return botocore.config.Config(region_name=self.region())
-
-    def create_resource(self, resource_name):
-        return self.boto_session().resource(resource_name)
+        return botocore.config.Config(  region_name=self.region(),
+                                        max_pool_connections=50,
+                                        retries={'mode': 'adaptive', 'max_attempts': 10},
+                                        tcp_keepalive=True  )
 
     def create_client(self, client_name):
-        try:
-            return self._clients[client_name]
-        except KeyError:
-            self._clients[client_name] = self.boto_session().client(client_name)
-            return self._clients[client_name]
+        with self._clients_lock:
+            try:
+                return self._clients[client_name]
+            except KeyError:
+                self._clients[client_name] = self.boto_session().client(client_name, config=self.boto_config())
+                return self._clients[client_name]
 
     def get_metric_widget_image(self, widget_dict):
         try:
             cloudwatch_client = self.create_client('cloudwatch')
             response = cloudwatch_client.get_metric_widget_image(
-                MetricWidget=json.dumps(widget_dict)
+                MetricWidget=json.dumps(widget_dict, separators=(',', ':'))
             )
             return response['MetricWidgetImage']
         except botocore.exceptions.ClientError as e:
@@ -95,34 +116,36 @@ class InfraHelper:
         except botocore.exceptions.ClientError as e:
             raise InfraHelperException(str(e))
 
-    def get_file_from_s3(self, bucket, object_key, output_path):
+    def get_file_bytes_from_s3(self, bucket, object_key):
         try:
+            import boto3.s3.transfer
             s3_client = self.create_client('s3')
-            s3_client.download_file(bucket, object_key, output_path)
+            file_buffer = io.BytesIO()
+            s3_client.download_fileobj(bucket, object_key, file_buffer,
+                                       Config=boto3.s3.transfer.TransferConfig(multipart_chunksize=8*1024*1024, max_concurrency=8))
+            return file_buffer.getvalue()
         except botocore.exceptions.ClientError as e:
             raise InfraHelperException(str(e))
 
     def gen_instance_dicts(self):
         try:
-            ec2 = self.create_resource('ec2')
-            for instance in ec2.instances.all():
-                yield { 'id': instance.id,
-                        'type': instance.instance_type,
-                        'state': instance.state['Name'] }
+            ec2_client = self.create_client('ec2')
+            paginator = ec2_client.get_paginator('describe_instances')
+            for page in paginator.paginate(PaginationConfig={'PageSize': 1000}):
+                for reservation in page['Reservations']:
+                    for instance in reservation['Instances']:
+                        yield { 'id': instance['InstanceId'],
+                                'type': instance['InstanceType'],
+                                'state': instance['State']['Name'] }
         except botocore.exceptions.ClientError as e:
             raise InfraHelperException(str(e))
 
     def gen_instance_counts(self):
-        per_state_and_type_count = {}
-        for instance_dict in self.gen_instance_dicts():
-            try:
-                per_state_and_type_count[(instance_dict['type'], instance_dict['state'])] += 1
-            except KeyError:
-                per_state_and_type_count[(instance_dict['type'], instance_dict['state'])] = 1
-        for i_type, i_state in per_state_and_type_count.keys():
+        per_state_and_type_count = collections.Counter((instance_dict['type'], instance_dict['state']) for instance_dict in self.gen_instance_dicts())
+        for (i_type, i_state), count in per_state_and_type_count.items():
             yield { 'type': i_type,
                     'state': i_state,
-                    'count': per_state_and_type_count[(i_type, i_state)] }
+                    'count': count }
 
 
 
@@ -134,12 +157,28 @@ class ReportPeriod(enum.Enum):
     LAST_MONTH = "LAST_MONTH"
     LAST_3_MONTHS = "LAST_3_MONTHS"
 
+    @classmethod
+    def parse(cls, report_period: str):
+        # member names and values are identical, so the name lookup table serves as a value lookup
+        try:
+            return cls.__members__[report_period.upper()]
+        except KeyError:
+            raise ValueError(f"Invalid report_period `{report_period}`")
+
 class ReportType(enum.Enum):
     REALTIME_EC2_USAGE_REPORT = 'REALTIME_EC2_USAGE_REPORT'
     EC2_USAGE_REPORT = 'EC2_USAGE_REPORT'
     BILLING_REPORT = 'BILLING_REPORT'
     AWS_BUDGET_NOTIFICATION = 'AWS_BUDGET_NOTIFICATION'
 
+    @classmethod
+    def parse(cls, report_type: str):
+        # member names and values are identical, so the name lookup table serves as a value lookup
+        try:
+            return cls.__members__[report_type.upper()]
+        except KeyError:
+            raise ValueError(f"Invalid report_type `{report_type}`")
+
 
 
 class Attachment:
@@ -190,9 +229,10 @@ class Ec2RealtimeUsageReport(Report):
 
     @classmethod
     def create(cls, infra_helper):
-        report_text = 'TYPE'.ljust(20) + 'STATE'.ljust(12) + 'COUNT'.ljust(5) + '\n' + ('-'*37) + '\n'
-        for instance_dict in infra_helper.gen_instance_counts():
-            report_text += f"{instance_dict['type'].ljust(20)}{instance_dict['state'].ljust(12)}{str(instance_dict['count']).ljust(5)}\n"
+        report_lines = ['TYPE'.ljust(20) + 'STATE'.ljust(12) + 'COUNT'.ljust(5), '-'*37]
+        report_lines.extend(f"{instance_dict['type'].ljust(20)}{instance_dict['state'].ljust(12)}{str(instance_dict['count']).ljust(5)}"
+                            for instance_dict in infra_helper.gen_instance_counts())
+        report_text = '\n'.join(report_lines) + '\n'
 
         body = (f"```" +
                 report_text +
@@ -204,13 +244,14 @@ class Ec2RealtimeUsageReport(Report):
 
 class Ec2UsageReport(Report):
 
+    # (relative ISO 8601 start, human readable string)
     PERIOD_LOOKUP = {
-        ReportPeriod.LAST_HOUR: "-PT1H",
-        ReportPeriod.LAST_8_HOURS: "-PT8H",
-        ReportPeriod.LAST_24_HOURS: "-PT24H",
-        ReportPeriod.LAST_WEEK: "-PT168H",
-        ReportPeriod.LAST_MONTH: "-PT720H",
-        ReportPeriod.LAST_3_MONTHS: "-PT2160H"
+        ReportPeriod.LAST_HOUR: ("-PT1H", "past hour"),
+        ReportPeriod.LAST_8_HOURS: ("-PT8H", "past 8 hours"),
+        ReportPeriod.LAST_24_HOURS: ("-PT24H", "past 24 hours"),
+        ReportPeriod.LAST_WEEK: ("-PT168H", "past week"),
+        ReportPeriod.LAST_MONTH: ("-PT720H", "past month"),
+        ReportPeriod.LAST_3_MONTHS: ("-PT2160H", "past 3 months")
     }
 
     INSTANCE_TYPES = [  'c5a.16xlarge',
@@ -218,18 +259,7 @@ class Ec2UsageReport(Report):
 
     @classmethod
     def human_period_string(cls, report_period: ReportPeriod):
-        if report_period == ReportPeriod.LAST_HOUR:
-            return "past hour"
-        elif report_period == ReportPeriod.LAST_8_HOURS:
-            return "past 8 hours"
-        elif report_period == ReportPeriod.LAST_24_HOURS:
-            return "past 24 hours"
-        elif report_period == ReportPeriod.LAST_WEEK:
-            return "past week"
-        elif report_period == ReportPeriod.LAST_MONTH:
-            return "past month"
-        elif report_period == ReportPeriod.LAST_3_MONTHS:
-            return "past 3 months"
+        return cls.PERIOD_LOOKUP[report_period][1]
 
     @classmethod
     def create_cloud_metric_widget_dict(cls, region: str, report_period: ReportPeriod):
@@ -248,7 +278,7 @@ class Ec2UsageReport(Report):
                     "label": "Number of instances"
                 }
             },
-            "start": cls.PERIOD_LOOKUP[report_period],
+            "start": cls.PERIOD_LOOKUP[report_period][0],
             "width": 1280,
             "height": 380,
         }
@@ -269,54 +299,78 @@ class BillingReport(Report):
     ACCOUNT_ID = '097039683978'
     S3_BUCKET = 'aws-billing-reports-097039683978'
 
+    USAGE_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
     MONTHS = ['', 'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
 
     @classmethod
-    def current_year_month(cls):
-        return (datetime.now().year, datetime.now().month)
+    @functools.lru_cache(maxsize=1)
+    def invocation_time(cls):
+        # read the clock once, so the report title, S3 key and spend periods always agree at a month boundary
+        return datetime.now()
+
+    @classmethod
+    def current_year_month(cls, now: typing.Optional[datetime] = None):
+        now = now or datetime.now()
+        return (now.year, now.month)
 
     @classmethod
-    def next_year_month(cls):
-        if datetime.now().month == 12:
-            return (datetime.now().year + 1, 1)
+    def next_year_month(cls, now: typing.Optional[datetime] = None):
+        now = now or datetime.now()
+        if now.month == 12:
+            return (now.year + 1, 1)
         else:
-            return (datetime.now().year, datetime.now().month + 1)
+            return (now.year, now.month + 1)
 
     @classmethod
+    @functools.lru_cache(maxsize=1)
     def current_billing_period(cls):
-        cur_year, cur_month = cls.current_year_month()
-        next_year, next_month = cls.next_year_month()
+        now = cls.invocation_time()
+        cur_year, cur_month = cls.current_year_month(now)
+        next_year, next_month = cls.next_year_month(now)
         return f"{cur_year}{cur_month:>02}01-{next_year}{next_month:>02}01"
 
     @classmethod
+    @functools.lru_cache(maxsize=1)
     def billing_period_human_string(cls):
-        cur_year, cur_month = cls.current_year_month()
-        next_year, next_month = cls.next_year_month()
+        now = cls.invocation_time()
+        cur_year, cur_month = cls.current_year_month(now)
+        next_year, next_month = cls.next_year_month(now)
         return f"01-{cls.MONTHS[cur_month]}-{cur_year} to 01-{cls.MONTHS[next_month]}-{next_year}"
 
     @classmethod
+    @functools.lru_cache(maxsize=1)
     def current_billing_report_key(cls):
         return f"reports/AwsCostOverview/{cls.current_billing_period()}/AwsCostOverview-00001.csv.zip"
 
     @classmethod
+    @functools.lru_cache(maxsize=1)
     def current_billing_report_file_name(cls):
         return f"aws-cost-usage-{cls.current_billing_period()}.csv.zip"
 
+    @classmethod
+    def clear_cached_periods(cls):
+        # the period strings are cached per invocation, warm containers may live on into the next day or month
+        cls.invocation_time.cache_clear()
+        cls.current_billing_period.cache_clear()
+        cls.billing_period_human_string.cache_clear()
+        cls.current_billing_report_key.cache_clear()
+        cls.current_billing_report_file_name.cache_clear()
+
     @classmethod
     def fetch_billing_report_bytes(cls, infra_helper):
-        with tempfile.TemporaryDirectory() as working_dir:
-            working_dir = pathlib.Path(working_dir)
-            infra_helper.get_file_from_s3(  bucket=cls.S3_BUCKET,
-                                            object_key=cls.current_billing_report_key(),
-                                            output_path=str(working_dir / cls.current_billing_report_file_name())  )
-            with open(working_dir / cls.current_billing_report_file_name(), 'rb') as f:
-                return f.read()
+        return infra_helper.get_file_bytes_from_s3( bucket=cls.S3_BUCKET,
+                                                    object_key=cls.current_billing_report_key()  )
 
 
     @classmethod
     def parse_per_period_spend(cls, billing_report_bytes):
-        cur_year, cur_month = cls.current_year_month()
-        next_year, next_month = cls.next_year_month()
+        import csv
+        import zipfile
+        now = cls.invocation_time()
+        cur_year, cur_month = cls.current_year_month(now)
+        next_year, next_month = cls.next_year_month(now)
+        cur_day = now.day
         periods = [
             {
                 'name': 'this-month',
@@ -324,52 +378,56 @@ class BillingReport(Report):
                 'end': datetime(next_year, next_month, 1)
             }
         ]
-        if datetime.now().day > 3:
+        if cur_day > 3:
             periods.append({
-                'name': f"day-{datetime.now().day - 3:>02}",
-                'start': datetime(datetime.now().year, datetime.now().month, datetime.now().day - 3),
-                'end': datetime(datetime.now().year, datetime.now().month, datetime.now().day - 2)
+                'name': f"day-{cur_day - 3:>02}",
+                'start': datetime(cur_year, cur_month, cur_day - 3),
+                'end': datetime(cur_year, cur_month, cur_day - 2)
             })
-        if datetime.now().day > 2:
+        if cur_day > 2:
             periods.append({
-                'name': f"day-{datetime.now().day - 2:>02}",
-                'start': datetime(datetime.now().year, datetime.now().month, datetime.now().day - 2),
-                'end': datetime(datetime.now().year, datetime.now().month, datetime.now().day - 1)
+                'name': f"day-{cur_day - 2:>02}",
+                'start': datetime(cur_year, cur_month, cur_day - 2),
+                'end': datetime(cur_year, cur_month, cur_day - 1)
             })
-        if datetime.now().day > 1:
+        if cur_day > 1:
             periods.append({
-                'name': f"day-{datetime.now().day - 1:>02}",
-                'start': datetime(datetime.now().year, datetime.now().month, datetime.now().day - 1),
-                'end': datetime(datetime.now().year, datetime.now().month, datetime.now().day)
+                'name': f"day-{cur_day - 1:>02}",
+                'start': datetime(cur_year, cur_month, cur_day - 1),
+                'end': datetime(cur_year, cur_month, cur_day)
             })
+        month_prefix = f"{cur_year}-{cur_month:>02}-"
+        # usage dates are fixed-width ISO 8601 strings, so they order the same way as the datetimes they represent
+        period_bounds = [(period['name'], period['start'].strftime(cls.USAGE_DATE_FORMAT), period['end'].strftime(cls.USAGE_DATE_FORMAT)) for period in periods]
         try:
             per_period_spend = {}
 
-            with tempfile.TemporaryDirectory() as working_dir:
-                working_dir = pathlib.Path(working_dir)
-
-                path_to_zip_file = working_dir / 'AwsCostOverview-00001.csv.zip'
-                with open(path_to_zip_file, 'wb') as f:
-                    f.write(billing_report_bytes)
-                with zipfile.ZipFile(path_to_zip_file, 'r') as zipf:
-                    zipf.extractall(working_dir)
-                with open(working_dir / 'AwsCostOverview-00001.csv', 'r') as f:
-                    csv_reader = csv.DictReader(f, delimiter=',', quotechar='"')
-                    for item in csv_reader:
+            with zipfile.ZipFile(io.BytesIO(billing_report_bytes), 'r') as zipf:
+                with io.TextIOWrapper(zipf.open('AwsCostOverview-00001.csv'), encoding='utf-8', newline='') as f:
+                    csv_reader = csv.reader(f, delimiter=',', quotechar='"')
+                    header = next(csv_reader)
+                    account_id_index = header.index('lineItem/UsageAccountId')
+                    start_date_index = header.index('lineItem/UsageStartDate')
+                    end_date_index = header.index('lineItem/UsageEndDate')
+                    cost_index = header.index('lineItem/UnblendedCost')
+                    for row in csv_reader:
                         
-                        if item['lineItem/UsageAccountId'] != cls.ACCOUNT_ID:
+                        if row[account_id_index] != cls.ACCOUNT_ID:
+                            continue
+                        # every period lies within the current month
+                        if not row[start_date_index].startswith(month_prefix):
                             continue
-                        start_date = datetime.strptime(item['lineItem/UsageStartDate'], '%Y-%m-%dT%H:%M:%SZ')
-                        end_date = datetime.strptime(item['lineItem/UsageEndDate'], '%Y-%m-%dT%H:%M:%SZ')
-                        for period in periods:
-                            if start_date >= period['start'] and end_date <= period['end']:
+                        start_date = row[start_date_index]
+                        end_date = row[end_date_index]
+                        for period_name, period_start, period_end in period_bounds:
+                            if start_date >= period_start and end_date <= period_end:
                                 try:
-                                    per_period_spend[period['name']] += float(item['lineItem/UnblendedCost'])
+                                    per_period_spend[period_name] += float(row[cost_index])
                                 except KeyError:
-                                    per_period_spend[period['name']] = float(item['lineItem/UnblendedCost'])
+                                    per_period_spend[period_name] = float(row[cost_index])
 
             return {period['name']: per_period_spend[period['name']] for period in periods if period['name'] in per_period_spend}
-        except TypeError:
+        except (TypeError, IndexError, StopIteration):
             raise ValueError(f"failed to parse billing report csv !")
 
 
@@ -380,9 +438,10 @@ class BillingReport(Report):
         logger.info(f"Extracting and parsing the cost & usage csv file ...")
         per_period_spend = cls.parse_per_period_spend(report_bytes)
         logger.info(f"Creating the billing report ...")
-        report_text = 'PERIOD'.ljust(20) + 'SPEND'.ljust(15) + '\n' + ('-'*35) + '\n'
-        for period_name, spend in per_period_spend.items():
-            report_text += f"{period_name.ljust(20)}${spend:<15.2f}\n"
+        report_lines = ['PERIOD'.ljust(20) + 'SPEND'.ljust(15), '-'*35]
+        report_lines.extend(f"{period_name.ljust(20)}${spend:<15.2f}"
+                            for period_name, spend in per_period_spend.items())
+        report_text = '\n'.join(report_lines) + '\n'
 
         body = (f"```" +
                 report_text +
@@ -393,7 +452,7 @@ class BillingReport(Report):
         return Report(  title=f'AWS Cost & Usage Report for {cls.billing_period_human_string()} has been updated.',
                         body=body,
                         attachments=[Attachment(attachment_name=cls.current_billing_report_file_name(),
-                                                attachment_bytes=cls.fetch_billing_report_bytes(infra_helper))] )
+                                                attachment_bytes=report_bytes)] )
 
 
 
@@ -414,21 +473,27 @@ class BudgetNotificationReport(Report):
 
 class ReportFactory:
 
+    @classmethod
+    def gen_region_reports(cls, create_report: typing.Callable[[InfraHelper], Report], report_regions: list):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(report_regions), 1)) as executor:
+            futures = [executor.submit(create_report, InfraHelper.for_region(report_region)) for report_region in report_regions]
+            # keep the reports in the order the regions were requested
+            for future in futures:
+                yield future.result()
+
     @classmethod
     def gen_reports(cls, report_spec: dict):
-        report_type = ReportType(report_spec['report_type'].upper())
+        report_type = ReportType.parse(report_spec['report_type'])
         if report_type == ReportType.EC2_USAGE_REPORT:
-            report_period = ReportPeriod(report_spec['report_period'].upper())
-            for report_region in report_spec['report_regions']:
-                infra_helper = InfraHelper(region=report_region)
-                yield Ec2UsageReport.create(infra_helper=InfraHelper(region=report_region),
-                                            report_period=report_period)
+            report_period = ReportPeriod.parse(report_spec['report_period'])
+            yield from cls.gen_region_reports(  create_report=lambda infra_helper: Ec2UsageReport.create(  infra_helper=infra_helper,
+                                                                                                        report_period=report_period  ),
+                                                report_regions=report_spec['report_regions']  )
         elif report_type == ReportType.REALTIME_EC2_USAGE_REPORT:
-            for report_region in report_spec['report_regions']:
-                infra_helper = InfraHelper(region=report_region)
-                yield Ec2RealtimeUsageReport.create(infra_helper)
+            yield from cls.gen_region_reports(  create_report=Ec2RealtimeUsageReport.create,
+                                                report_regions=report_spec['report_regions']  )
         elif report_type == ReportType.BILLING_REPORT:
-            yield BillingReport.create(infra_helper=InfraHelper(region=os.environ['AWS_REGION']))
+            yield BillingReport.create(infra_helper=InfraHelper.for_region(os.environ['AWS_REGION']))
         elif report_type == ReportType.AWS_BUDGET_NOTIFICATION:
             yield BudgetNotificationReport.create(  subject=report_spec['subject'],
                                                     message=report_spec['message'] )
@@ -456,6 +521,7 @@ class ReportPublisherToSlack(ReportPublisher):
 
     def slack_client(self):
         if not self._slack_client:
+            import slack_sdk
             self._slack_client = slack_sdk.WebClient(token=self.slack_token())
         return self._slack_client
         
@@ -465,9 +531,8 @@ class ReportPublisherToSlack(ReportPublisher):
         field_values = list(fields.items())
         if (len(field_values) % 2):
             field_values.append((' ', ' '))
-        while field_values:
-            k1, v1 = field_values.pop(0)
-            k2, v2 = field_values.pop(0)
+        field_values = iter(field_values)
+        for (k1, v1), (k2, v2) in zip(field_values, field_values):
             yield {
                 "type": "section",
                 "text": {
@@ -526,19 +591,19 @@ class ReportPublisherToSlack(ReportPublisher):
 
 
     def publish(self, report: Report):
+        import slack_sdk.errors
         try:
             message_dict = self.create_slack_message_dict(  slack_channel=self.slack_channel(),
                                                             report=report )
             self.slack_client().chat_postMessage(**message_dict)
 
-            for attachment in report.attachments():
-                file_type = pathlib.Path(attachment.attachment_name()).suffix
-                response = self.slack_client().files_upload(
-                    channels=self.slack_channel(),
-                    file=attachment.attachment_bytes(),
-                    filename=attachment.attachment_name(),
-                    title=attachment.attachment_name(),
-                    filetype=file_type
+            file_uploads = [{   'file': attachment.attachment_bytes(),
+                                'filename': attachment.attachment_name(),
+                                'title': attachment.attachment_name()   } for attachment in report.attachments()]
+            if file_uploads:
+                self.slack_client().files_upload_v2(
+                    channel=self.slack_channel(),
+                    file_uploads=file_uploads
                 )
         except slack_sdk.errors.SlackApiError as e:
             raise ReportPublisherException(f"Failed to publish report to slack channel: {e}")
@@ -563,10 +628,10 @@ class ReportSpecFactory:
                 elif sns_event['Subject'].startswith('ALARM'):
                     message_dict = json.loads(sns_event['Message'])
                     alarm_arn = message_dict['AlarmArn']
-                    try:
-                        region = next(region for region in InfraHelper.REGIONS if region in alarm_arn)
-                    except StopIteration:
+                    region_match = InfraHelper.REGION_PATTERN.search(alarm_arn)
+                    if not region_match:
                         raise ValueError(f"Failed to parse region from alarm_arn")
+                    region = region_match.group(0)
                     return {
                         "report_type": "EC2_USAGE_REPORT",
                         "report_regions": [region],
@@ -599,19 +664,13 @@ class ArgValidator:
     def ensure_valid_report_period(cls, report_spec: dict):
         assert 'report_period' in report_spec, f"`report_period` not present in report_spec"
         assert type(report_spec['report_period']) == str, f"invalid type of `report_period` in report_spec"  
-        try:
-            ReportPeriod(report_spec['report_period'].upper())
-        except ValueError:
-            raise ValueError(f"Invalid report_period `{report_spec['report_period']}`")
+        ReportPeriod.parse(report_spec['report_period'])
 
     @classmethod
     def ensure_valid_report_type(cls, report_spec: dict):
         assert 'report_type' in report_spec, f"`report_type` not present in report_spec"
         assert type(report_spec['report_type']) == str, f"invalid type of `report_type` in report_spec"  
-        try:
-            ReportType(report_spec['report_type'].upper())
-        except ValueError:
-            raise ValueError(f"Invalid report_type `{report_spec['report_type']}`")
+        return ReportType.parse(report_spec['report_type'])
 
     @classmethod
     def ensure_valid_report_regions(cls, report_spec: dict):
@@ -622,11 +681,11 @@ class ArgValidator:
 
     @classmethod
     def ensure_valid_report_spec(cls, report_spec: dict):
-        cls.ensure_valid_report_type(report_spec)
-        if ReportType(report_spec['report_type'].upper()) == ReportType.EC2_USAGE_REPORT:
+        report_type = cls.ensure_valid_report_type(report_spec)
+        if report_type == ReportType.EC2_USAGE_REPORT:
             cls.ensure_valid_report_period(report_spec)
             cls.ensure_valid_report_regions(report_spec)
-        elif ReportType(report_spec['report_type'].upper()) == ReportType.REALTIME_EC2_USAGE_REPORT:
+        elif report_type == ReportType.REALTIME_EC2_USAGE_REPORT:
             assert 'report_period' not in report_spec, f"`report_period` not expected for this report_type"
             cls.ensure_valid_report_regions(report_spec)
         else:
@@ -637,6 +696,7 @@ class ArgValidator:
 
 def lambda_handler(event, context):
     logger.info(f"Lambda invoked with event: {event}")
+    BillingReport.clear_cached_periods()
 
     if 'report_type' in event:
         report_spec = event
@@ -645,7 +705,7 @@ def lambda_handler(event, context):
 
     ArgValidator.ensure_valid_report_spec(report_spec)
 
-    infra_helper = InfraHelper(region=os.environ['AWS_REGION'])
+    infra_helper = InfraHelper.for_region(os.environ['AWS_REGION'])
     slack_config = json.loads(infra_helper.get_secret_value('ec2_usage_report_bot_secret'))
     report_publisher = ReportPublisherToSlack(  slack_token=slack_config['slack-token'],
                                                 slack_channel=slack_config['slack-channel']  )
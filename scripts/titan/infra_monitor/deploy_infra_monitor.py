@@ -1,5 +1,4 @@
 import typing
-import pathlib
 import logging
 import argparse
 import zipfile
@@ -7,16 +6,17 @@ import time
 import tempfile
 import json
 import os
+import re
 import shutil
-import botocore
-import boto3
+import threading
 from importlib import resources
 
 from titan.infra_monitor import (
     LambdaPackage,
     LambdaDependenciesPackage,
     InfraHelperException,
-    InfraHelper
+    InfraHelper,
+    VALID_REGIONS
 )
 
 
@@ -27,12 +27,17 @@ logger = logging.getLogger(__name__)
 
 class Deployer:
 
-    def __init__(self, region: str, account_id: str, force_overwrite: bool):
+    MANAGED_ALARM_NAMES = ('SuddenIncreaseInInstancesAlarm', 'SuddenDecreaseInInstancesAlarm')
+
+    def __init__(self, region: str, account_id: str, force_overwrite: bool, packages_bucket: str = None, use_package_cache: bool = True):
         self._region = region
         self._account_id = account_id
         self._force_overwrite = force_overwrite
-        self._infra_helper = InfraHelper(   region=self.region(),
-                                            account_id=self.account_id()  )
+        self._packages_bucket = packages_bucket
+        self._use_package_cache = use_package_cache
+        self._infra_helper = None
+        self._infra_helper_lock = threading.Lock()
+
     def region(self):
         return self._region
 
@@ -42,8 +47,18 @@ class Deployer:
     def force_overwrite(self):
         return self._force_overwrite
 
+    def packages_bucket(self):
+        return self._packages_bucket
+
+    def use_package_cache(self):
+        return self._use_package_cache
+
     def infra_helper(self):
-        return self._infra_helper
+        with self._infra_helper_lock:
+            if not self._infra_helper:
+                self._infra_helper = InfraHelper(   region=self.region(),
+                                                    account_id=self.account_id()  )
+            return self._infra_helper
 
     @classmethod
     def create_lambda_policy_doc(cls, region, account_id, lambda_name, secret_arn_prefix):
@@ -166,22 +181,27 @@ class Deployer:
 
     def remove_lambda_function(self, lambda_name: str):
         logger.info(f"Attempting to remove any previous resource associated with infra-monitor ...")
+        # the IAM resources have to be removed in order, but they do not depend on the function itself
+        InfraHelper.run_parallel([ lambda: self.delete_lambda_function(lambda_name),
+                                   lambda: self.delete_lambda_iam_resources(lambda_name) ])
+
+    def delete_lambda_function(self, lambda_name: str):
         try:
             self.infra_helper().delete_lambda_function(lambda_name)
         except InfraHelperException as e:
             logger.info(f"Failed to delete lambda function `{lambda_name}`: {e}")
+
+    def delete_lambda_iam_resources(self, lambda_name: str):
+        # deleting the role also removes its inline policy and detaches any managed one
         try:
-            self.infra_helper().detach_policy_from_lambda_role(lambda_name)
+            self.infra_helper().delete_lambda_role(lambda_name)
         except InfraHelperException as e:
-            logger.info(f"Failed to detach IAM policy from role for lambda `{lambda_name}`: {e}")
+            logger.info(f"Failed to delete IAM role for lambda `{lambda_name}`: {e}")
+        # deployments made before the switch to inline policies still have a managed one
         try:
             self.infra_helper().delete_lambda_policy(lambda_name)
         except InfraHelperException as e:
             logger.info(f"Failed to delete IAM policy for lambda `{lambda_name}`: {e}")
-        try:
-            self.infra_helper().delete_lambda_role(lambda_name)
-        except InfraHelperException as e:
-            logger.info(f"Failed to delete IAM role for lambda `{lambda_name}`: {e}")
 
     def unschedule_lambda_function(self, lambda_name: str):
         try:
@@ -189,32 +209,43 @@ class Deployer:
         except InfraHelperException as e:
             logger.info(f"Failed to unschedule lambda `{lambda_name}`: {e}")
 
+    def remove_scheduled_lambda_function(self, lambda_name: str):
+        self.unschedule_lambda_function(lambda_name)
+        self.remove_lambda_function(lambda_name)
+
     def schedule_lambda_function(self, lambda_name: str, interval_mins: int):
         self.infra_helper().schedule_lambda_function(   lambda_name=lambda_name,
                                                         interval_mins=interval_mins )
 
-    def deploy_lambda_function(self, lambda_name: str, package_bytes: bytes):
-        self.infra_helper().create_lambda_policy(   lambda_name=lambda_name,
-                                                    policy_doc=self.create_lambda_policy_doc(   region=self.region(),
-                                                                                                account_id=self.account_id(),
-                                                                                                lambda_name=lambda_name,
-                                                                                                secret_arn_prefix=self.infra_helper().create_secret_arn_prefix(lambda_name)  ))
-        self.infra_helper().wait_for_lambda_policy(lambda_name)
+    def create_lambda_role(self, lambda_name: str):
         self.infra_helper().create_lambda_role(lambda_name)
         self.infra_helper().wait_for_lambda_role(lambda_name)
-        self.infra_helper().attach_policy_to_lambda_role(lambda_name)
-        self.infra_helper().wait_for_aws(15)
+
+    def deploy_lambda_function(self, lambda_name: str, package_bytes: bytes):
+        self.create_lambda_role(lambda_name)
+        self.infra_helper().put_inline_lambda_policy(   lambda_name=lambda_name,
+                                                        policy_doc=self.create_lambda_policy_doc(   region=self.region(),
+                                                                                                    account_id=self.account_id(),
+                                                                                                    lambda_name=lambda_name,
+                                                                                                    secret_arn_prefix=self.infra_helper().create_secret_arn_prefix(lambda_name)  ))
         self.infra_helper().create_lambda_function(lambda_name=lambda_name,
-                                            package_bytes=package_bytes)
-        self.infra_helper().wait_for_lambda_function(lambda_name)
+                                            package_bytes=package_bytes,
+                                            packages_bucket=self.packages_bucket())
+
 
 
+    def deploy_lambda_package(self, lambda_name: str, compresslevel: int = 1):
+        package_path = resources.files(f"scripts.titan.infra_monitor.assets.{lambda_name}")
+        self.deploy_lambda_function(lambda_name=lambda_name,
+                                    package_bytes=LambdaPackage.cached_package_bytes(  package_path,
+                                                                                        compresslevel,
+                                                                                        use_cache=self.use_package_cache()  ))
 
-    def deploy_lambda_package(self, lambda_name: str):
-        with resources.path(f"scripts.titan.infra_monitor.assets.{lambda_name}", "__init__.py") as p:
-            package_path = pathlib.Path(p).parent
-            self.deploy_lambda_function(lambda_name=lambda_name,
-                                        package_bytes=LambdaPackage.create_package_bytes(package_path))
+    def deploy_scheduled_lambda_package(self, lambda_name: str, interval_mins: int):
+        self.deploy_lambda_package(lambda_name)
+        self.infra_helper().wait_for_lambda_function(lambda_name)
+        self.schedule_lambda_function(  lambda_name=lambda_name,
+                                        interval_mins=interval_mins )
 
     def remove_cloudwatch_topic(self, topic_name):
         try:
@@ -225,15 +256,15 @@ class Deployer:
 
     def remove_cloudwatch_alarms(self, alarm_names):
         try:
-            self.infra_helper().delete_cloudwatch_alarms(['SuddenIncreaseInInstancesAlarm', 'SuddenDecreaseInInstancesAlarm'])
+            self.infra_helper().delete_cloudwatch_alarms(list(alarm_names))
         except InfraHelperException as e:
             logger.info(f"Failed to delete CloudWatch alarms: {e}")
 
 
 
-    def create_instance_count_growth_alarm_fields(self, topic_arn):
+    def create_instance_count_change_alarm_fields(self, topic_arn, alarm_description, threshold, comparison_operator):
         return {
-            "AlarmDescription": 'Sudden increase in number of EC2 running instances',
+            "AlarmDescription": alarm_description,
             "ActionsEnabled": True,
             "OKActions": [],
             "AlarmActions": [
@@ -242,8 +273,8 @@ class Deployer:
             "InsufficientDataActions": [],
             "EvaluationPeriods": 1,
             "DatapointsToAlarm": 1,
-            "Threshold": 1.2,
-            "ComparisonOperator": "GreaterThanOrEqualToThreshold",
+            "Threshold": threshold,
+            "ComparisonOperator": comparison_operator,
             "TreatMissingData": "missing",
             "Metrics": [
                 {
@@ -273,47 +304,17 @@ class Deployer:
             ]
         }
 
+    def create_instance_count_growth_alarm_fields(self, topic_arn):
+        return self.create_instance_count_change_alarm_fields(  topic_arn=topic_arn,
+                                                                alarm_description='Sudden increase in number of EC2 running instances',
+                                                                threshold=1.2,
+                                                                comparison_operator='GreaterThanOrEqualToThreshold'  )
+
     def create_instance_count_decline_alarm_fields(self, topic_arn):
-        return {
-            "AlarmDescription": 'Sudden decrease in number of EC2 running instances',
-            "ActionsEnabled": True,
-            "OKActions": [],
-            "AlarmActions": [
-                topic_arn
-            ],
-            "InsufficientDataActions": [],
-            "EvaluationPeriods": 1,
-            "DatapointsToAlarm": 1,
-            "Threshold": 0.8,
-            "ComparisonOperator": "LessThanOrEqualToThreshold",
-            "TreatMissingData": "missing",
-            "Metrics": [
-                {
-                    "Id": "e1",
-                    "Label": "Proportional change in running instances",
-                    "ReturnData": True,
-                    "Expression": "IF(DIFF(m1) == 0, 1.0, IF((m1-DIFF(m1))==0, 99.9, m1/(m1-DIFF(m1))))"#"IF(DIFF(m1)==0, 0, 100*(DIFF(m1) / (m1 - DIFF(m1))))"#"100*(DIFF(m1) / (m1 - DIFF(m1)))"
-                },
-                {
-                    "Id": "m1",
-                    "ReturnData": False,
-                    "MetricStat": {
-                        "Metric": {
-                            "Namespace": "InfraMonitor",
-                            "MetricName": "InstanceCountPerState",
-                            "Dimensions": [
-                                {
-                                    "Name": "InstanceState",
-                                    "Value": "running"
-                                }
-                            ]
-                        },
-                        "Period": 60,
-                        "Stat": "Average"
-                    }
-                }
-            ]
-        }
+        return self.create_instance_count_change_alarm_fields(  topic_arn=topic_arn,
+                                                                alarm_description='Sudden decrease in number of EC2 running instances',
+                                                                threshold=0.8,
+                                                                comparison_operator='LessThanOrEqualToThreshold'  )
 
 
     # def delete_secret(self, secret_name):
@@ -323,30 +324,28 @@ class Deployer:
     #         logger.info(f"Failed to delete secret `{secret_name}`: {e}")
 
     def create_or_update_secret(self, secret_name, secret_value):
-        try:
+        current_secret_value = self.infra_helper().get_secret_value(secret_name)
+        if current_secret_value is None:
             self.infra_helper().create_secret(  secret_name=secret_name,
                                                 secret_value=secret_value  )
-        except InfraHelperException as e:
+        elif current_secret_value != secret_value:
             self.infra_helper().update_secret(  secret_name=secret_name,
                                                 secret_value=secret_value  )
+        else:
+            logger.info(f"Secret `{secret_name}` is unchanged, skipping update")
 
     def undeploy(self):
         # self.delete_secret('ec2_usage_report_bot_secret')
-        self.remove_lambda_function('ec2_usage_report_bot')
-        self.unschedule_lambda_function('ec2_usage_metrics')
-        self.remove_lambda_function('ec2_usage_metrics')
-        self.remove_cloudwatch_topic('infra-monitor')
-        self.remove_cloudwatch_alarms(['SuddenIncreaseInInstancesAlarm', 'SuddenDecreaseInInstancesAlarm'])
+        InfraHelper.run_parallel([ lambda: self.remove_lambda_function('ec2_usage_report_bot'),
+                                   lambda: self.remove_scheduled_lambda_function('ec2_usage_metrics'),
+                                   lambda: self.remove_cloudwatch_topic('infra-monitor'),
+                                   lambda: self.remove_cloudwatch_alarms(self.MANAGED_ALARM_NAMES) ])
 
     def deploy(self, slack_token, slack_channel):
         if self.force_overwrite():
             self.undeploy()
         self.create_or_update_secret(   secret_name=self.infra_helper().create_secret_name('ec2_usage_report_bot'),
                                         secret_value=json.dumps({'slack-token': slack_token, 'slack-channel': slack_channel})  )
-        self.deploy_lambda_package('ec2_usage_report_bot')
-        self.deploy_lambda_package('ec2_usage_metrics')
-        self.schedule_lambda_function(  lambda_name='ec2_usage_metrics',
-                                        interval_mins=1 )
 
         topic_name = 'infra-monitor'
         topic_arn = self.infra_helper().create_sns_topic_arn(topic_name)
@@ -354,11 +353,17 @@ class Deployer:
                                                 policy_doc=self.create_sns_topic_policy_doc(account_id=self.account_id(),
                                                                                             topic_arn=topic_arn,
                                                                                             bucket_arn='arn:aws:s3:::aws-billing-reports-097039683978')  )
-        self.infra_helper().create_cloudwatch_alarm(alarm_name='SuddenIncreaseInInstancesAlarm',
-                                                    alarm_fields=self.create_instance_count_growth_alarm_fields(topic_arn=topic_arn))
-        self.infra_helper().create_cloudwatch_alarm(alarm_name='SuddenDecreaseInInstancesAlarm',
-                                                    alarm_fields=self.create_instance_count_decline_alarm_fields(topic_arn=topic_arn))
-        self.infra_helper().wait_for_cloudwatch_alarms(['SuddenIncreaseInInstancesAlarm', 'SuddenDecreaseInInstancesAlarm'])
+        # the lambdas and the alarms only depend on the secret and the topic created above
+        InfraHelper.run_parallel([ lambda: self.deploy_lambda_package('ec2_usage_report_bot'),
+                                   lambda: self.deploy_scheduled_lambda_package(   lambda_name='ec2_usage_metrics',
+                                                                                   interval_mins=1 ),
+                                   lambda: self.infra_helper().create_cloudwatch_alarm(alarm_name='SuddenIncreaseInInstancesAlarm',
+                                                                                       alarm_fields=self.create_instance_count_growth_alarm_fields(topic_arn=topic_arn)),
+                                   lambda: self.infra_helper().create_cloudwatch_alarm(alarm_name='SuddenDecreaseInInstancesAlarm',
+                                                                                       alarm_fields=self.create_instance_count_decline_alarm_fields(topic_arn=topic_arn)) ])
+        # the report bot only has to be active once the topic starts delivering to it
+        InfraHelper.run_parallel([ lambda: self.infra_helper().wait_for_cloudwatch_alarms(list(self.MANAGED_ALARM_NAMES)),
+                                   lambda: self.infra_helper().wait_for_lambda_function('ec2_usage_report_bot') ])
         self.infra_helper().create_sns_lambda_subscription(topic_name, 'ec2_usage_report_bot')
 
 
@@ -367,29 +372,13 @@ class ArgValidator:
     
     @classmethod
     def ensure_valid_region(cls, region: str):
-        assert region in {  'us-east-2',
-                            'us-east-1',
-                            'us-west-1',
-                            'us-west-2',
-                            'af-south-1',
-                            'ap-east-1',
-                            'ap-southeast-3',
-                            'ap-south-1',
-                            'ap-northeast-3',
-                            'ap-northeast-2',
-                            'ap-southeast-1',
-                            'ap-southeast-2',
-                            'ap-northeast-1',
-                            'ca-central-1',
-                            'eu-central-1',
-                            'eu-west-1',
-                            'eu-west-2',
-                            'eu-south-1',
-                            'eu-west-3',
-                            'eu-north-1',
-                            'me-south-1',
-                            'sa-east-1' }, f"Invalid region `{self.region()}`"
+        assert region in VALID_REGIONS, f"Invalid region `{region}`"
 
+    @classmethod
+    def ensure_valid_account_id(cls, account_id: str):
+        # account ids are always 12 digits and may start with 0
+        if not re.fullmatch(r'[0-9]{12}', account_id):
+            raise ValueError(f"Invalid account_id `{account_id}`")
 
     @classmethod
     def ensure_valid_env(cls):
@@ -405,6 +394,8 @@ def main():
     parser.add_argument("-r", "--region", type=str, required=True, help="Region to deploy to")
     parser.add_argument("-a", "--account-id", type=str, required=True, help="AWS account id")
     parser.add_argument("-f", "--force-overwrite", action='store_true', default=False, required=False, help="Force overwrite any existing version of Infra Monitor")
+    parser.add_argument("-b", "--packages-bucket", type=str, required=False, help="S3 bucket to upload lambda packages to, instead of sending them inline")
+    parser.add_argument("--no-package-cache", action='store_true', default=False, required=False, help="Rebuild lambda packages instead of reusing cached ones")
     parser.add_argument("-u", "--undeploy", action='store_true', default=False, required=False, help="Remove any existing version of Infra Monitor")
     args = parser.parse_args()
 
@@ -414,6 +405,7 @@ def main():
 
     try:
         ArgValidator.ensure_valid_region(args.region)
+        ArgValidator.ensure_valid_account_id(args.account_id)
         ArgValidator.ensure_valid_env()
         if args.undeploy:
             Deployer(   region=args.region,
@@ -422,7 +414,9 @@ def main():
         else:
             Deployer(   region=args.region,
                         account_id=args.account_id,
-                        force_overwrite=args.force_overwrite   ).deploy(slack_token=os.environ['SLACK_TOKEN'],
+                        force_overwrite=args.force_overwrite,
+                        packages_bucket=args.packages_bucket,
+                        use_package_cache=not args.no_package_cache   ).deploy(slack_token=os.environ['SLACK_TOKEN'],
                                                                         slack_channel=os.environ['SLACK_CHANNEL'])
     except Exception as e:
         print(f"Failed due to exception: {e}")
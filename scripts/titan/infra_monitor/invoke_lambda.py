@@ -1,11 +1,14 @@
 import typing
-import pathlib
 import logging
 import argparse
 import json
+import re
+import threading
+import concurrent.futures
 from titan.infra_monitor import (
     InfraHelper,
-    LambdaPackage
+    LambdaPackage,
+    VALID_REGIONS
 )
 from importlib import resources
 
@@ -16,6 +19,10 @@ logger = logging.getLogger(__name__)
 
 class LambdaExecutor:
 
+    # shared by every executor in the process so repeated invocations reuse the same clients
+    _infra_helpers = {}
+    _infra_helpers_lock = threading.Lock()
+
     def __init__(self, region: str, account_id: str):
         self._region = region
         self._account_id = account_id
@@ -26,23 +33,63 @@ class LambdaExecutor:
     def account_id(self):
         return self._account_id
 
+    def infra_helper(self):
+        key = (self.region(), self.account_id())
+        with self._infra_helpers_lock:
+            try:
+                return self._infra_helpers[key]
+            except KeyError:
+                self._infra_helpers[key] = InfraHelper( region=self.region(),
+                                                        account_id=self.account_id() )
+                return self._infra_helpers[key]
+
     def invoke(self, lambda_name: str, event_dict: dict):
-        infra_helper = InfraHelper( region=self.region(),
-                                    account_id=self.account_id() )
-        response = infra_helper.invoke_lambda_function( lambda_name=lambda_name,
-                                                        event_dict=event_dict )
+        response = self.infra_helper().invoke_lambda_function(  lambda_name=lambda_name,
+                                                                event_dict=event_dict,
+                                                                parse_payload=True )
         print(json.dumps(response, indent=4))
 
+    def invoke_many(self, lambda_name: str, event_dicts: typing.List[dict]):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [executor.submit(self.invoke, lambda_name=lambda_name, event_dict=event_dict) for event_dict in event_dicts]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+
 
 
 class LocalLambdaExecutor(LambdaExecutor):
+
+    def __init__(self, region: str, account_id: str, use_package_cache: bool = True):
+        super().__init__(region=region, account_id=account_id)
+        self._use_package_cache = use_package_cache
+
+    def use_package_cache(self):
+        return self._use_package_cache
     
+    def package_bytes(self, lambda_name: str):
+        package_path = resources.files(f"scripts.titan.infra_monitor.assets.{lambda_name}")
+        # built for this machine rather than the lambda runtime, since it runs here
+        return LambdaPackage.cached_package_bytes(  package_path,
+                                                    use_cache=self.use_package_cache(),
+                                                    for_lambda_runtime=False )
+
+    def execute(self, package_bytes: bytes, event_dict: dict):
+        response = LambdaPackage.execute_package(   package_bytes=package_bytes,
+                                                    event_dict=event_dict  )
+        print(json.dumps(response, indent=4))
+
     def invoke(self, lambda_name: str, event_dict: dict):
-        with resources.path(f"scripts.titan.infra_monitor.assets.{lambda_name}", "__init__.py") as p:
-            package_path = pathlib.Path(p).parent
-            package_bytes = LambdaPackage.create_package_bytes(package_path)
-            LambdaPackage.execute_package(  package_bytes=package_bytes,
-                                            event_dict=event_dict  )
+        self.execute(   package_bytes=self.package_bytes(lambda_name),
+                        event_dict=event_dict  )
+
+    def invoke_many(self, lambda_name: str, event_dicts: typing.List[dict]):
+        # build once up front, otherwise every thread would build the same package on a cold cache
+        package_bytes = self.package_bytes(lambda_name)
+        # each event runs in its own interpreter, so these really do run concurrently
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [executor.submit(self.execute, package_bytes=package_bytes, event_dict=event_dict) for event_dict in event_dicts]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
 
 
 
@@ -51,42 +98,20 @@ class ArgValidator:
     
     @classmethod
     def ensure_valid_region(cls, region: str):
-        assert region in {  'us-east-2',
-                            'us-east-1',
-                            'us-west-1',
-                            'us-west-2',
-                            'af-south-1',
-                            'ap-east-1',
-                            'ap-southeast-3',
-                            'ap-south-1',
-                            'ap-northeast-3',
-                            'ap-northeast-2',
-                            'ap-southeast-1',
-                            'ap-southeast-2',
-                            'ap-northeast-1',
-                            'ca-central-1',
-                            'eu-central-1',
-                            'eu-west-1',
-                            'eu-west-2',
-                            'eu-south-1',
-                            'eu-west-3',
-                            'eu-north-1',
-                            'me-south-1',
-                            'sa-east-1' }, f"Invalid region `{self.region()}`"
+        assert region in VALID_REGIONS, f"Invalid region `{region}`"
 
     @classmethod
     def ensure_valid_account_id(cls, account_id: str):
-        try:
-            assert str(int(account_id)) == account_id
-        except Exception as e:
-            raise ValueError(f"Invalid account_id")
+        # account ids are always 12 digits and may start with 0
+        if not re.fullmatch(r'[0-9]{12}', account_id):
+            raise ValueError(f"Invalid account_id `{account_id}`")
 
     @classmethod
-    def ensure_valid_json_file_path(cls, json_file_path: str):
+    def load_valid_json_file(cls, json_file_path: str):
         try:
             with open(json_file_path, 'r') as f:
-                json.loads(f.read())
-        except:
+                return json.load(f)
+        except (OSError, TypeError, ValueError):
             raise ValueError(f"Invalid JSON file path `{json_file_path}` !")
 
 def main():
@@ -94,8 +119,11 @@ def main():
     parser.add_argument("-n", "--lambda-name", type=str, required=True, help="Lambda Function Name")
     parser.add_argument("-r", "--region", type=str, required=True, help="Region to deploy to")
     parser.add_argument("-a", "--account-id", type=str, required=True, help="AWS account id")
-    parser.add_argument("-e", "--event-file", type=str, required=False, help="Path to json file containing event")
+    event_group = parser.add_mutually_exclusive_group()
+    event_group.add_argument("-e", "--event-file", type=str, required=False, help="Path to json file containing event")
+    event_group.add_argument("--event-files", type=str, nargs='+', required=False, help="Paths to json files containing events to invoke concurrently")
     parser.add_argument("-l", "--local", action='store_true', default=False, required=False, help="Execute lambda locally")
+    parser.add_argument("--no-package-cache", action='store_true', default=False, required=False, help="Rebuild the lambda package instead of reusing a cached one")
     args = parser.parse_args()
 
     # configure the logger
@@ -105,19 +133,21 @@ def main():
     try:
         ArgValidator.ensure_valid_region(args.region)
         ArgValidator.ensure_valid_account_id(args.account_id)
-        if args.event_file:
-            ArgValidator.ensure_valid_json_file_path(args.event_file)
-
-        Executor = LocalLambdaExecutor if args.local else LambdaExecutor
-        if args.event_file:
-            with open(args.event_file, 'r') as f:
-                Executor( region=args.region,
-                                account_id=args.account_id ).invoke(lambda_name=args.lambda_name,
-                                                                    event_dict=json.loads(f.read()))
+        if args.local:
+            executor = LocalLambdaExecutor( region=args.region,
+                                            account_id=args.account_id,
+                                            use_package_cache=not args.no_package_cache )
+        else:
+            executor = LambdaExecutor(  region=args.region,
+                                        account_id=args.account_id )
+        if args.event_files:
+            event_dicts = [ArgValidator.load_valid_json_file(event_file) for event_file in args.event_files]
+            executor.invoke_many(   lambda_name=args.lambda_name,
+                                    event_dicts=event_dicts)
         else:
-            Executor(   region=args.region,
-                        account_id=args.account_id ).invoke(lambda_name=args.lambda_name,
-                                                            event_dict={})
+            event_dict = ArgValidator.load_valid_json_file(args.event_file) if args.event_file else {}
+            executor.invoke(lambda_name=args.lambda_name,
+                            event_dict=event_dict)
     except Exception as e:
         print(f"Failed due to exception: {e}")
         raise
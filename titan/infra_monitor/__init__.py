@@ -4,5 +4,6 @@ from titan.infra_monitor.lambda_package import (
 )
 from titan.infra_monitor.infra_helper import (
     InfraHelperException,
-    InfraHelper
+    InfraHelper,
+    VALID_REGIONS
 )
\ No newline at end of file
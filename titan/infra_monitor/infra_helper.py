@@ -1,8 +1,14 @@
 import logging
 import time
+import random
+import threading
+import functools
+import concurrent.futures
 import json
-import botocore
-import boto3
+import io
+import hashlib
+import botocore.config
+import botocore.exceptions
 from titan.infra_monitor.lambda_package import (
     LambdaPackage,
     LambdaDependenciesPackage
@@ -12,15 +18,59 @@ from titan.infra_monitor.lambda_package import (
 logger = logging.getLogger(__name__)
 
 
+VALID_REGIONS = frozenset({  'us-east-2',
+                             'us-east-1',
+                             'us-west-1',
+                             'us-west-2',
+                             'af-south-1',
+                             'ap-east-1',
+                             'ap-southeast-3',
+                             'ap-south-1',
+                             'ap-northeast-3',
+                             'ap-northeast-2',
+                             'ap-southeast-1',
+                             'ap-southeast-2',
+                             'ap-northeast-1',
+                             'ca-central-1',
+                             'eu-central-1',
+                             'eu-west-1',
+                             'eu-west-2',
+                             'eu-south-1',
+                             'eu-west-3',
+                             'eu-north-1',
+                             'me-south-1',
+                             'sa-east-1' })
+
+
 class InfraHelperException(Exception):
     pass
 
 class InfraHelper:
 
+    # shared by every helper in the process so credentials are only resolved once
+    _boto_session = None
+    # clients (and their connection pools) are shared by every helper in the same region
+    _clients = {}
+    # clients are thread-safe once created, but creating them off the session is not
+    _boto_session_lock = threading.Lock()
+
+    BOTO_CONFIG = botocore.config.Config(   max_pool_connections=50,
+                                            retries={'mode': 'adaptive', 'max_attempts': 10},
+                                            tcp_keepalive=True  )
+
+    LAMBDA_ASSUME_ROLE_POLICY_JSON = json.dumps({
+      "Version": "2012-10-17",
+      "Statement": {
+        "Effect": "Allow",
+        "Principal": {"Service": "lambda.amazonaws.com"},
+        "Action": "sts:AssumeRole"
+      }
+    }, separators=(',', ':'))
+
     def __init__(self, region: str, account_id: str):
         self._region = region
         self._account_id = account_id
-        self._clients = {}        
+        self._boto_config = self.BOTO_CONFIG.merge(botocore.config.Config(region_name=region))
 
     def region(self):
         return self._region
@@ -28,19 +78,53 @@ class InfraHelper:
     def account_id(self):
         return self._account_id
 
+    @classmethod
+    def boto_session(cls):
+        if not cls._boto_session:
+            import boto3
+            cls._boto_session = boto3.session.Session()
+        return cls._boto_session
+
     def boto_config(self):
-        return botocore.config.Config(region_name=self.region())
+        return self._boto_config
 
     def create_client(self, client_name):
-        try:
-            return self._clients[client_name]
-        except KeyError:
-            self._clients[client_name] = boto3.client(client_name, config=self.boto_config())
-            return self._clients[client_name]
-
-    def wait_for_aws(self, wait_time):
-        logger.info(f"Sleeping a bit to wait for AWS")
-        time.sleep(wait_time)
+        key = (self.region(), client_name)
+        with self._boto_session_lock:
+            try:
+                return self._clients[key]
+            except KeyError:
+                self._clients[key] = self.boto_session().client(client_name, config=self.boto_config())
+                return self._clients[key]
+
+    @classmethod
+    def run_parallel(cls, tasks):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [executor.submit(task) for task in tasks]
+            return [future.result() for future in futures]
+
+    @classmethod
+    def client_error_code(cls, e: botocore.exceptions.ClientError):
+        return e.response.get('Error', {}).get('Code')
+
+    @classmethod
+    def poll_until(cls, poll, retry_error_codes, is_ready=lambda response: True, timeout_seconds=20, cap=2.0, base=0.05):
+        # exponential backoff with full jitter, so parallel deploys do not poll in lockstep
+        deadline = time.monotonic() + timeout_seconds
+        attempt = 0
+        while True:
+            try:
+                response = poll()
+                if is_ready(response):
+                    return response
+            except botocore.exceptions.ClientError as e:
+                if (cls.client_error_code(e) not in retry_error_codes) or (time.monotonic() >= deadline):
+                    raise
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise InfraHelperException(f"Gave up polling after {timeout_seconds} seconds")
+            time.sleep(min(remaining, random.uniform(0, min(cap, base * 2**attempt))))
+            attempt += 1
 
     def create_lambda_arn(self, lambda_name):
         return f"arn:aws:lambda:{self.region()}:{self.account_id()}:function:{lambda_name}"
@@ -63,32 +147,19 @@ class InfraHelper:
     def create_events_rule_arn(self, lambda_name):
         return f"arn:aws:events:{self.region()}:{self.account_id()}:rule/{self.create_events_rule_name(lambda_name)}"
 
-    def create_lambda_policy(self, lambda_name, policy_doc):
-        try:
-            iam = self.create_client('iam')
-            response = iam.create_policy(
-                PolicyName=self.create_lambda_policy_name(lambda_name),
-                PolicyDocument=json.dumps(policy_doc)
-            )
-            return response
-        except botocore.exceptions.ClientError as e:
-            raise InfraHelperException(str(e))
-
+    @classmethod
+    def policy_doc_json(cls, policy_doc):
+        # documents that are already serialized are passed through as they are
+        if isinstance(policy_doc, str):
+            return policy_doc
+        return json.dumps(policy_doc, separators=(',', ':'))
 
     def create_lambda_role(self, lambda_name):
         try:
             iam = self.create_client('iam')
-            role_policy = {
-              "Version": "2012-10-17",
-              "Statement": {
-                "Effect": "Allow",
-                "Principal": {"Service": "lambda.amazonaws.com"},
-                "Action": "sts:AssumeRole"
-              }
-            }
             response = iam.create_role(
                 RoleName=self.create_lambda_role_name(lambda_name),
-                AssumeRolePolicyDocument=json.dumps(role_policy),
+                AssumeRolePolicyDocument=self.LAMBDA_ASSUME_ROLE_POLICY_JSON,
             )
             return response
         except botocore.exceptions.ClientError as e:
@@ -99,78 +170,97 @@ class InfraHelper:
         try:
             logger.info(f"Waiting for lambda role `{self.create_lambda_role_name(lambda_name)}` ...")
             iam = self.create_client('iam')
-            waiter = iam.get_waiter('role_exists')
-            waiter.wait(
-                RoleName=self.create_lambda_role_name(lambda_name)
-            )
+            self.poll_until(poll=lambda: iam.get_role(RoleName=self.create_lambda_role_name(lambda_name)),
+                            retry_error_codes={'NoSuchEntity'},
+                            timeout_seconds=20,
+                            cap=1.0)
         except botocore.exceptions.ClientError as e:
             raise InfraHelperException(str(e))
 
 
-    def wait_for_lambda_policy(self, lambda_name):
-        try:
-            logger.info(f"Waiting for lambda policy {self.create_lambda_policy_arn(lambda_name)} ...")
-            iam = self.create_client('iam')
-            waiter = iam.get_waiter('policy_exists')
-            waiter.wait(
-                PolicyArn=self.create_lambda_policy_arn(lambda_name)
-            )
-        except botocore.exceptions.ClientError as e:
-            raise InfraHelperException(str(e))
-
+    @classmethod
+    def is_lambda_function_active(cls, response):
+        state = response['Configuration'].get('State')
+        if state == 'Failed':
+            raise InfraHelperException(f"Lambda function failed to become active: {response['Configuration'].get('StateReason')}")
+        return state == 'Active'
 
     def wait_for_lambda_function(self, lambda_name):
         try:
             logger.info(f"Waiting for lambda function `{lambda_name}` ...")
             lambda_client = self.create_client('lambda')
-            waiter = lambda_client.get_waiter('function_active')
-            waiter.wait(FunctionName=lambda_name)
-        except botocore.exceptions.ClientError as e:
-            raise InfraHelperException(str(e))
-
-    def create_lambda_function(self, lambda_name, package_bytes):
-        try:
-            lambda_client = self.create_client('lambda')
-            response = lambda_client.create_function(
-                FunctionName=lambda_name,
-                Runtime='python3.9',
-                Role=self.create_lambda_role_arn(lambda_name),
-                Handler='lambda_function.lambda_handler',
-                Code={
-                    'ZipFile': package_bytes
-                },
-                Timeout=300, # Maximum allowable timeout
-                MemorySize=512
-            )
-            return response
+            self.poll_until(poll=lambda: lambda_client.get_function(FunctionName=lambda_name),
+                            retry_error_codes={'ResourceNotFoundException'},
+                            is_ready=self.is_lambda_function_active,
+                            timeout_seconds=300,
+                            cap=5.0)
         except botocore.exceptions.ClientError as e:
             raise InfraHelperException(str(e))
 
+    @classmethod
+    def is_role_not_assumable_error(cls, e: botocore.exceptions.ClientError):
+        error = e.response.get('Error', {})
+        return (error.get('Code') == 'InvalidParameterValueException') and ('cannot be assumed by Lambda' in error.get('Message', ''))
 
-    def attach_policy_to_lambda_role(self, lambda_name):
+    def upload_lambda_package(self, lambda_name, package_bytes, bucket):
         try:
-            iam = self.create_client('iam')
-            response = iam.attach_role_policy(
-                RoleName=self.create_lambda_role_name(lambda_name),
-                PolicyArn=self.create_lambda_policy_arn(lambda_name)
-            )
-            return response
+            s3_client = self.create_client('s3')
+            object_key = f"infra-monitor/{lambda_name}/{hashlib.sha256(package_bytes).hexdigest()}.zip"
+            s3_client.upload_fileobj(io.BytesIO(package_bytes), bucket, object_key)
+            logger.info(f"Uploaded lambda package to `s3://{bucket}/{object_key}`")
+            return object_key
         except botocore.exceptions.ClientError as e:
             raise InfraHelperException(str(e))
 
-
-    def detach_policy_from_lambda_role(self, lambda_name):
+    def create_lambda_function(self, lambda_name, package_bytes, max_wait_seconds=15, packages_bucket=None):
+        lambda_client = self.create_client('lambda')
+        # going through S3 avoids sending the package base64-encoded inside the request
+        if packages_bucket:
+            code = {
+                'S3Bucket': packages_bucket,
+                'S3Key': self.upload_lambda_package(lambda_name, package_bytes, packages_bucket)
+            }
+        else:
+            code = {
+                'ZipFile': package_bytes
+            }
+        waited_seconds = 0
+        attempt = 0
+        while True:
+            try:
+                response = lambda_client.create_function(
+                    FunctionName=lambda_name,
+                    Runtime=f"python{LambdaDependenciesPackage.PYTHON_VERSION}",
+                    Role=self.create_lambda_role_arn(lambda_name),
+                    Handler='lambda_function.lambda_handler',
+                    Code=code,
+                    Timeout=300, # Maximum allowable timeout
+                    MemorySize=512
+                )
+                return response
+            except botocore.exceptions.ClientError as e:
+                # a freshly created role takes a few seconds to become assumable by lambda
+                if (not self.is_role_not_assumable_error(e)) or (waited_seconds >= max_wait_seconds):
+                    raise InfraHelperException(str(e))
+                wait_seconds = min(2**attempt, 4, max_wait_seconds - waited_seconds)
+                logger.info(f"Waiting {wait_seconds}s for role `{self.create_lambda_role_name(lambda_name)}` to propagate ...")
+                time.sleep(wait_seconds)
+                waited_seconds += wait_seconds
+                attempt += 1
+
+
+    def put_inline_lambda_policy(self, lambda_name, policy_doc):
         try:
             iam = self.create_client('iam')
-            response = iam.detach_role_policy(
+            response = iam.put_role_policy(
                 RoleName=self.create_lambda_role_name(lambda_name),
-                PolicyArn=self.create_lambda_policy_arn(lambda_name)
+                PolicyName=self.create_lambda_policy_name(lambda_name),
+                PolicyDocument=self.policy_doc_json(policy_doc)
             )
             return response
         except botocore.exceptions.ClientError as e:
             raise InfraHelperException(str(e))
 
-
     def delete_lambda_policy(self, lambda_name):
         try:
             iam = self.create_client('iam')
@@ -183,34 +273,45 @@ class InfraHelper:
 
     def delete_lambda_role(self, lambda_name):
         try:
-            iam_resource = boto3.resource('iam')
-            role = iam_resource.Role(self.create_lambda_role_name(lambda_name))
-            role.delete()
+            iam = self.create_client('iam')
+            role_name = self.create_lambda_role_name(lambda_name)
+            # a role can only be deleted once no policy is left on it
+            attached_policy_arns = [    policy['PolicyArn']
+                                        for page in iam.get_paginator('list_attached_role_policies').paginate(RoleName=role_name)
+                                        for policy in page['AttachedPolicies']  ]
+            inline_policy_names = [ policy_name
+                                    for page in iam.get_paginator('list_role_policies').paginate(RoleName=role_name)
+                                    for policy_name in page['PolicyNames']  ]
+            self.run_parallel(  [functools.partial(iam.detach_role_policy, RoleName=role_name, PolicyArn=policy_arn) for policy_arn in attached_policy_arns] +
+                                [functools.partial(iam.delete_role_policy, RoleName=role_name, PolicyName=policy_name) for policy_name in inline_policy_names]  )
+            response = iam.delete_role(RoleName=role_name)
+            return response
         except botocore.exceptions.ClientError as e:
             raise InfraHelperException(str(e))
 
 
     def delete_lambda_function(self, lambda_name):
         try:
-            iam = self.create_client('iam')
             lambda_client = self.create_client('lambda')
-            response = lambda_client.delete_function(
+            lambda_client.delete_function(
                 FunctionName=lambda_name
             )
         except botocore.exceptions.ClientError as e:
             raise InfraHelperException(str(e))
 
 
-    def invoke_lambda_function(self, lambda_name, event_dict: dict):
+    def invoke_lambda_function(self, lambda_name, event_dict: dict, parse_payload: bool = False):
         try:
-            iam = self.create_client('iam')
             lambda_client = self.create_client('lambda')
             response = lambda_client.invoke(
                 FunctionName=lambda_name,
-                Payload=json.dumps(event_dict),
+                Payload=json.dumps(event_dict, separators=(',', ':')),
             )
             if 'Payload' in response:
-                response['Payload'] = response['Payload'].read().decode("utf-8")
+                if parse_payload:
+                    response['Payload'] = json.load(response['Payload'])
+                else:
+                    response['Payload'] = response['Payload'].read().decode("utf-8")
             return response
         except botocore.exceptions.ClientError as e:
             raise InfraHelperException(str(e))
@@ -222,18 +323,15 @@ class InfraHelper:
             eventbridge_client.delete_rule(Name=self.create_events_rule_name(lambda_name))
             logger.info(f"Removed rule `{self.create_events_rule_name(lambda_name)}`")
         except botocore.exceptions.ClientError as e:
+            if self.client_error_code(e) == 'ResourceNotFoundException':
+                logger.info(f"Rule `{self.create_events_rule_name(lambda_name)}` does not exist, nothing to unschedule")
+                return
             logger.error(f"Failed to remove rule `{self.create_events_rule_name(lambda_name)}`: {e}")
             raise InfraHelperException(str(e))
 
 
-    def schedule_lambda_function(self, lambda_name, interval_mins: int):
+    def allow_events_rule_to_invoke_lambda(self, lambda_name):
         try:
-            eventbridge_client = self.create_client('events')
-            unit = 'minute' if interval_mins == 1 else 'minutes'
-            response = eventbridge_client.put_rule( Name=self.create_events_rule_name(lambda_name),
-                                                    ScheduleExpression=f"rate({interval_mins} {unit})")
-            logger.info(f"Put rule {self.create_events_rule_name(lambda_name)} with ARN {response['RuleArn']}")
-            self.wait_for_aws(2)
             lambda_client = self.create_client('lambda')
             lambda_client.add_permission(   FunctionName=lambda_name,
                                             StatementId=f'{lambda_name}-invoke',
@@ -241,7 +339,12 @@ class InfraHelper:
                                             Principal='events.amazonaws.com',
                                             SourceArn=self.create_events_rule_arn(lambda_name)  )
             logger.info(f"Granted permission to let Amazon EventBridge call function `{lambda_name}")
-            self.wait_for_aws(2)
+        except botocore.exceptions.ClientError as e:
+            raise InfraHelperException(str(e))
+
+    def set_lambda_as_events_rule_target(self, lambda_name):
+        try:
+            eventbridge_client = self.create_client('events')
             response = eventbridge_client.put_targets(  Rule=self.create_events_rule_name(lambda_name),
                                                         Targets=[{'Id': lambda_name, 'Arn': self.create_lambda_arn(lambda_name)}]  )
             if response['FailedEntryCount'] > 0:
@@ -251,6 +354,21 @@ class InfraHelper:
         except botocore.exceptions.ClientError as e:
             raise InfraHelperException(str(e))
 
+    def schedule_lambda_function(self, lambda_name, interval_mins: int):
+        try:
+            eventbridge_client = self.create_client('events')
+            unit = 'minute' if interval_mins == 1 else 'minutes'
+            response = eventbridge_client.put_rule( Name=self.create_events_rule_name(lambda_name),
+                                                    ScheduleExpression=f"rate({interval_mins} {unit})")
+            logger.info(f"Put rule {self.create_events_rule_name(lambda_name)} with ARN {response['RuleArn']}")
+            self.poll_until(poll=lambda: eventbridge_client.describe_rule(Name=self.create_events_rule_name(lambda_name)),
+                            retry_error_codes={'ResourceNotFoundException'})
+        except botocore.exceptions.ClientError as e:
+            raise InfraHelperException(str(e))
+        # both only need the rule to exist
+        self.run_parallel([ lambda: self.allow_events_rule_to_invoke_lambda(lambda_name),
+                            lambda: self.set_lambda_as_events_rule_target(lambda_name) ])
+
 
     def create_sns_topic_arn(self, topic_name):
         return f'arn:aws:sns:{self.region()}:{self.account_id()}:{topic_name}'
@@ -262,7 +380,7 @@ class InfraHelper:
                 Name=topic_name,
                 Attributes={
                     'FifoTopic': "False",
-                    'Policy': json.dumps(policy_doc)
+                    'Policy': self.policy_doc_json(policy_doc)
                 }
             )
             return response
@@ -295,8 +413,12 @@ class InfraHelper:
         try:
             sns_client = self.create_client('sns')
             # remove subscriptions
-            for subscription in sns_client.list_subscriptions_by_topic(TopicArn=self.create_sns_topic_arn(topic_name)).get('Subscriptions'):
-                sns_client.unsubscribe(SubscriptionArn=subscription.get('SubscriptionArn'))
+            paginator = sns_client.get_paginator('list_subscriptions_by_topic')
+            subscriptions = [   subscription
+                                for page in paginator.paginate(TopicArn=self.create_sns_topic_arn(topic_name))
+                                for subscription in page.get('Subscriptions', [])  ]
+            self.run_parallel([ functools.partial(sns_client.unsubscribe, SubscriptionArn=subscription.get('SubscriptionArn'))
+                                for subscription in subscriptions ])
             response = sns_client.delete_topic(
                 TopicArn=self.create_sns_topic_arn(topic_name)
             )
@@ -340,7 +462,7 @@ class InfraHelper:
         try:
             cloudwatch_client = self.create_client('cloudwatch')
             response = cloudwatch_client.get_metric_widget_image(
-                MetricWidget=json.dumps(widget_dict)
+                MetricWidget=json.dumps(widget_dict, separators=(',', ':'))
             )
             return response
         except botocore.exceptions.ClientError as e:
@@ -352,6 +474,18 @@ class InfraHelper:
     def create_secret_arn_prefix(self, lambda_name):
         return f'arn:aws:secretsmanager:{self.region()}:{self.account_id()}:secret:{self.create_secret_name(lambda_name)}'
 
+    def get_secret_value(self, secret_name):
+        try:
+            secret_client = self.create_client('secretsmanager')
+            response = secret_client.get_secret_value(
+                SecretId=secret_name
+            )
+            return response.get('SecretString')
+        except botocore.exceptions.ClientError as e:
+            if self.client_error_code(e) == 'ResourceNotFoundException':
+                return None
+            raise InfraHelperException(str(e))
+
     def create_secret(self, secret_name, secret_value):
         try:
             secret_client = self.create_client('secretsmanager')
@@ -4,6 +4,11 @@ import zipfile
 import tempfile
 import os
 import json
+import hashlib
+import subprocess
+import sys
+import sysconfig
+import io
 
 
 logger = logging.getLogger(__name__)
@@ -11,43 +16,139 @@ logger = logging.getLogger(__name__)
 
 class LambdaDependenciesPackage:
 
+    # the lambda runtime the dependencies get installed for
+    PYTHON_VERSION = '3.9'
+    PLATFORM = 'manylinux2014_x86_64'
+
+    @classmethod
+    def is_packaged_file(cls, relative_path: pathlib.PurePath):
+        return not (('__pycache__' in relative_path.parts) or
+                    (relative_path.suffix == '.pyc') or
+                    (relative_path.name == 'RECORD' and relative_path.parent.name.endswith('.dist-info')))
+
+    @classmethod
+    def target_name(cls, for_lambda_runtime: bool = True):
+        if for_lambda_runtime:
+            return f"{cls.PLATFORM}-python{cls.PYTHON_VERSION}"
+        return f"{sysconfig.get_platform()}-{sys.implementation.cache_tag}"
+
     @classmethod
-    def create(cls, requirements: str, output_path: str):
+    def pip_target_args(cls, for_lambda_runtime: bool = True):
+        if not for_lambda_runtime:
+            # whatever the local interpreter would install, so the package can run in-process
+            return []
+        # only prebuilt wheels for the lambda runtime, never a local sdist build
+        return [    '--platform', cls.PLATFORM,
+                    '--implementation', 'cp',
+                    '--python-version', cls.PYTHON_VERSION,
+                    '--only-binary=:all:'  ]
+
+    @classmethod
+    def create(cls, requirements: str, output_path: str, compresslevel: int = 1, for_lambda_runtime: bool = True):
+        with zipfile.ZipFile(output_path, 'w') as zip:
+            cls.write_to_zip(requirements, zip, compresslevel, for_lambda_runtime)
+
+    @classmethod
+    def write_to_zip(cls, requirements: str, zip: zipfile.ZipFile, compresslevel: int = 1, for_lambda_runtime: bool = True):
         with tempfile.TemporaryDirectory() as working_dir:
             working_dir = pathlib.Path(working_dir)
             with open(working_dir / 'requirements.txt', 'w') as f:
                 f.write(requirements)
-            os.system(f"pip install -r {working_dir / 'requirements.txt'} --target {working_dir / 'deps'}")
-            os.system(f"cd {working_dir / 'deps'} && zip -r {output_path} .")
+            # pycs would be built for the local interpreter, not necessarily the lambda runtime
+            subprocess.run( [   sys.executable, '-m', 'pip', 'install',
+                                '--no-compile',
+                                '--disable-pip-version-check',
+                                *cls.pip_target_args(for_lambda_runtime),
+                                '--target', str(working_dir / 'deps'),
+                                '-r', str(working_dir / 'requirements.txt')  ],
+                            check=True  )
+            for file_path in sorted((working_dir / 'deps').rglob('*')):
+                if file_path.is_file() and cls.is_packaged_file(file_path.relative_to(working_dir / 'deps')):
+                    zip.write(  file_path,
+                                file_path.relative_to(working_dir / 'deps').as_posix(),
+                                compress_type=LambdaPackage.zip_compress_type(file_path.name, file_path.stat().st_size),
+                                compresslevel=compresslevel  )
 
 class LambdaPackage:
 
+    PACKAGE_FILE_NAMES = ('requirements.txt', 'lambda_function.py', '__main__.py')
+    # bump whenever the way packages are built changes, so stale cached packages are not reused
+    PACKAGE_FORMAT_VERSION = 1
+    CACHE_PATH = pathlib.Path.home() / '.cache' / 'infra-monitor'
+    # deflating these gains nothing
+    STORED_SUFFIXES = frozenset({'.png', '.jpg', '.zip', '.gz', '.whl'})
+    STORED_MAX_SIZE = 256
+
     @classmethod
-    def add_file_to_zip(cls, zip_file_path, some_file_path):
-        zip = zipfile.ZipFile(zip_file_path, 'a')
-        zip.write(some_file_path, os.path.basename(some_file_path))
-        zip.close()
+    def zip_compress_type(cls, file_name, file_size):
+        if file_size < cls.STORED_MAX_SIZE or os.path.splitext(file_name)[1] in cls.STORED_SUFFIXES:
+            return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
 
     @classmethod
-    def create_package_bytes(cls, package_path):
-        requirements = open(package_path / 'requirements.txt', 'r').read()
+    def write_file_to_zip(cls, zip: zipfile.ZipFile, some_file_path, compresslevel: int = 1):
+        file_bytes = some_file_path.read_bytes()
+        zip.writestr(   some_file_path.name,
+                        file_bytes,
+                        compress_type=cls.zip_compress_type(some_file_path.name, len(file_bytes)),
+                        compresslevel=compresslevel  )
+
+    @classmethod
+    def create_package_bytes(cls, package_path, compresslevel: int = 1, for_lambda_runtime: bool = True):
+        requirements = (package_path / 'requirements.txt').read_text()
         # create and merge with dependencies
-        with tempfile.TemporaryDirectory() as working_dir:
-            working_path = pathlib.Path(working_dir)
-            result_zip_path = working_path / 'package.zip'
+        package_buffer = io.BytesIO()
+        with zipfile.ZipFile(package_buffer, 'w') as zip:
             if requirements:
-                LambdaDependenciesPackage.create(requirements, result_zip_path)
-            cls.add_file_to_zip(result_zip_path, package_path / 'lambda_function.py')
-            cls.add_file_to_zip(result_zip_path, package_path / '__main__.py')
-            return open(result_zip_path, 'rb').read()
+                LambdaDependenciesPackage.write_to_zip(requirements, zip, compresslevel, for_lambda_runtime)
+            cls.write_file_to_zip(zip, package_path / 'lambda_function.py', compresslevel)
+            cls.write_file_to_zip(zip, package_path / '__main__.py', compresslevel)
+        return package_buffer.getvalue()
 
+    @classmethod
+    def package_digest(cls, package_path, compresslevel: int = 1, for_lambda_runtime: bool = True):
+        digest = hashlib.sha256()
+        digest.update(f"format={cls.PACKAGE_FORMAT_VERSION}".encode() + b'\0')
+        digest.update(f"target={LambdaDependenciesPackage.target_name(for_lambda_runtime)}".encode() + b'\0')
+        digest.update(f"compresslevel={compresslevel}".encode() + b'\0')
+        for file_name in cls.PACKAGE_FILE_NAMES:
+            digest.update(file_name.encode() + b'\0')
+            digest.update((package_path / file_name).read_bytes() + b'\0')
+        return digest.hexdigest()
 
     @classmethod
-    def execute_package(cls, package_bytes: bytes, event_dict: json):
+    def cached_package_bytes(cls, package_path, compresslevel: int = 1, use_cache: bool = True, for_lambda_runtime: bool = True):
+        cache_file_path = cls.CACHE_PATH / f"{cls.package_digest(package_path, compresslevel, for_lambda_runtime)}.zip"
+        # without the cache, always rebuild but still refresh the cached copy
+        if use_cache:
+            try:
+                return cache_file_path.read_bytes()
+            except FileNotFoundError:
+                pass
+        package_bytes = cls.create_package_bytes(package_path, compresslevel, for_lambda_runtime)
+        try:
+            cls.CACHE_PATH.mkdir(parents=True, exist_ok=True)
+            # write then rename so concurrent builds never read a partial zip
+            with tempfile.NamedTemporaryFile(dir=cls.CACHE_PATH, delete=False) as f:
+                f.write(package_bytes)
+            os.replace(f.name, cache_file_path)
+        except OSError as e:
+            logger.warning(f"Failed to cache lambda package `{cache_file_path}`: {e}")
+        return package_bytes
+
+    @classmethod
+    def execute_package(cls, package_bytes: bytes, event_dict: dict):
         with tempfile.TemporaryDirectory() as working_dir:
             working_path = pathlib.Path(working_dir)
-            with open(working_path / 'lambda_package.zip', 'wb') as f:
-                f.write(package_bytes)
+            with zipfile.ZipFile(io.BytesIO(package_bytes)) as zip:
+                zip.extractall(working_path / 'package')
             with open(working_path / 'event.json', 'w') as f:
-                f.write(json.dumps(event_dict))
-            os.system(f"cd {working_path} && python {working_path / 'lambda_package.zip'} -e {working_path / 'event.json'}")
\ No newline at end of file
+                json.dump(event_dict, f)
+            # a separate interpreter per run, so the package's modules never leak into this process
+            subprocess.run( [   sys.executable, str(working_path / 'package'),
+                                '-e', str(working_path / 'event.json'),
+                                '-o', str(working_path / 'response.json')  ],
+                            cwd=working_path,
+                            check=True  )
+            with open(working_path / 'response.json', 'r') as f:
+                return json.load(f)